@@ -11,8 +11,11 @@ from test_framework.util import (
     assert_equal,
     assert_raises_rpc_error,
 )
+import http.client
 import json
 import os
+import struct
+import urllib.parse
 
 TESTSDIR = os.path.dirname(os.path.realpath(__file__))
 
@@ -35,8 +38,22 @@ class GetblockstatsTest(BitcoinTestFramework):
         self.num_nodes = 1
         self.setup_clean_chain = True
 
+    def setup_network(self):
+        if self.options.gen_test_data:
+            # generate_test_data fetches the raw blocks through the REST interface
+            self.extra_args = [['-rest']]
+        super().setup_network()
+
+    def batch(self, requests):
+        """Send requests to node 0 in a single batch and return their results in order"""
+        results = self.nodes[0].batch(requests)
+        for res in results:
+            assert_equal(res.get('error'), None)
+        return [res['result'] for res in results]
+
     def get_stats(self):
-        return [self.nodes[0].getblockstats(hash_or_height=self.start_height + i) for i in range(self.max_stat_pos+1)]
+        getblockstats = self.nodes[0].getblockstats
+        return self.batch([getblockstats.get_request(hash_or_height=self.start_height + i) for i in range(self.max_stat_pos+1)])
 
     def generate_test_data(self, filename):
         mocktime = 1525107225
@@ -46,28 +63,41 @@ class GetblockstatsTest(BitcoinTestFramework):
         address = self.nodes[0].get_deterministic_priv_key().address
         self.nodes[0].sendtoaddress(address=address, amount=10, subtractfeefromamount=True)
         self.nodes[0].generate(1)
-        self.sync_all()
 
-        self.nodes[0].sendtoaddress(address=address, amount=10, subtractfeefromamount=True)
-        self.nodes[0].sendtoaddress(address=address, amount=10, subtractfeefromamount=False)
-        self.nodes[0].settxfee(amount=0.003)
-        self.nodes[0].sendtoaddress(address=address, amount=1, subtractfeefromamount=True)
-        self.sync_all()
+        # The batch is executed in order, so settxfee only affects the last send
+        sendtoaddress = self.nodes[0].sendtoaddress
+        self.batch([
+            sendtoaddress.get_request(address=address, amount=10, subtractfeefromamount=True),
+            sendtoaddress.get_request(address=address, amount=10, subtractfeefromamount=False),
+            self.nodes[0].settxfee.get_request(amount=0.003),
+            sendtoaddress.get_request(address=address, amount=1, subtractfeefromamount=True),
+        ])
         self.nodes[0].generate(1)
 
         self.expected_stats = self.get_stats()
 
-        blocks = []
-        tip = self.nodes[0].getbestblockhash()
-        blockhash = None
-        height = 0
-        while tip != blockhash:
-            blockhash = self.nodes[0].getblockhash(height)
-            blocks.append(self.nodes[0].getblock(blockhash, 0))
-            height += 1
-
+        node = self.nodes[0]
+        getblockhash = node.getblockhash
+        blockhashes = self.batch([getblockhash.get_request(h) for h in range(node.getblockcount() + 1)])
+
+        # Fetch the raw blocks in binary over REST to skip the hex encoding
+        # and JSON envelope of getblock. They are stored in a separate file,
+        # each one prefixed by its size as a little-endian uint32.
+        url = urllib.parse.urlparse(node.url)
+        conn = http.client.HTTPConnection(url.hostname, url.port)
+        with open(filename + '.dat', 'wb') as f:
+            for blockhash in blockhashes:
+                conn.request('GET', '/rest/block/%s.bin' % blockhash)
+                resp = conn.getresponse()
+                assert_equal(resp.status, 200)
+                block = resp.read()
+                f.write(struct.pack('<I', len(block)))
+                f.write(block)
+        conn.close()
+
+        # The blocks only live in the .dat file, the JSON file holds the
+        # mocktime and the expected stats
         to_dump = {
-            'blocks': blocks,
             'mocktime': int(mocktime),
             'stats': self.expected_stats,
         }
@@ -77,16 +107,27 @@ class GetblockstatsTest(BitcoinTestFramework):
     def load_test_data(self, filename):
         with open(filename, 'r', encoding="utf8") as f:
             d = json.load(f)
-            blocks = d['blocks']
             mocktime = d['mocktime']
             self.expected_stats = d['stats']
 
-        # Set the timestamps from the file so that the nodes can get out of Initial Block Download
+        blocks = []
+        with open(filename + '.dat', 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos < len(data):
+            size, = struct.unpack_from('<I', data, pos)
+            pos += 4
+            assert pos + size <= len(data), 'Truncated block at offset %d in %s.dat' % (pos, filename)
+            blocks.append(data[pos:pos + size].hex())
+            pos += size
+
+        # Set the timestamps from the file so that the node can get out of Initial Block Download
         self.nodes[0].setmocktime(mocktime)
-        self.sync_all()
 
-        for b in blocks:
-            self.nodes[0].submitblock(b)
+        # Submit all blocks in a single batch request. The batch is processed
+        # in order, so each block's parent is known by the time it is submitted.
+        submitblock = self.nodes[0].submitblock
+        self.batch([submitblock.get_request(b) for b in blocks])
 
 
     def run_test(self):
@@ -96,46 +137,50 @@ class GetblockstatsTest(BitcoinTestFramework):
         else:
             self.load_test_data(test_data)
 
-        self.sync_all()
+        getblockstats = self.nodes[0].getblockstats
         stats = self.get_stats()
 
         # Make sure all valid statistics are included but nothing else is
         expected_keys = self.expected_stats[0].keys()
-        assert_equal(set(stats[0].keys()), set(expected_keys))
+        assert_equal(stats[0].keys(), expected_keys)
 
         assert_equal(stats[0]['height'], self.start_height)
         assert_equal(stats[self.max_stat_pos]['height'], self.start_height + self.max_stat_pos)
 
         for i in range(self.max_stat_pos+1):
-            self.log.info('Checking block %d\n' % (i))
+            self.log.info('Checking block %d' % (i))
             assert_equal(stats[i], self.expected_stats[i])
 
             # Check selecting block by hash too
             blockhash = self.expected_stats[i]['blockhash']
-            stats_by_hash = self.nodes[0].getblockstats(hash_or_height=blockhash)
+            stats_by_hash = getblockstats(hash_or_height=blockhash)
             assert_equal(stats_by_hash, self.expected_stats[i])
 
         # Make sure each stat can be queried on its own
-        for stat in expected_keys:
-            for i in range(self.max_stat_pos+1):
-                result = self.nodes[0].getblockstats(hash_or_height=self.start_height + i, stats=[stat])
+        for i in range(self.max_stat_pos+1):
+            results = self.batch([getblockstats.get_request(hash_or_height=self.start_height + i, stats=[stat]) for stat in expected_keys])
+            selected = {}
+            for stat, result in zip(expected_keys, results):
                 assert_equal(list(result.keys()), [stat])
-                if result[stat] != self.expected_stats[i][stat]:
-                    self.log.info('result[%s] (%d) failed, %r != %r' % (
-                        stat, i, result[stat], self.expected_stats[i][stat]))
-                assert_equal(result[stat], self.expected_stats[i][stat])
+                selected[stat] = result[stat]
+            if selected != self.expected_stats[i]:
+                for stat in expected_keys:
+                    if selected[stat] != self.expected_stats[i][stat]:
+                        self.log.info('result[%s] (%d) failed, %r != %r' % (
+                            stat, i, selected[stat], self.expected_stats[i][stat]))
+            assert_equal(selected, self.expected_stats[i])
 
         # Make sure only the selected statistics are included (more than one)
         some_stats = {'minfee', 'maxfee'}
-        stats = self.nodes[0].getblockstats(hash_or_height=1, stats=list(some_stats))
-        assert_equal(set(stats.keys()), some_stats)
+        stats = getblockstats(hash_or_height=1, stats=list(some_stats))
+        assert_equal(stats.keys(), some_stats)
 
         # Test invalid parameters raise the proper json exceptions
         tip = self.start_height + self.max_stat_pos
         assert_raises_rpc_error(-8, 'Target block height %d after current tip %d' % (tip+1, tip),
-                                self.nodes[0].getblockstats, hash_or_height=tip+1)
+                                getblockstats, hash_or_height=tip+1)
         assert_raises_rpc_error(-8, 'Target block height %d is negative' % (-1),
-                                self.nodes[0].getblockstats, hash_or_height=-1)
+                                getblockstats, hash_or_height=-1)
 
         # Make sure not valid stats aren't allowed
         inv_sel_stat = 'asdfghjkl'
@@ -147,18 +192,18 @@ class GetblockstatsTest(BitcoinTestFramework):
         ]
         for inv_stat in inv_stats:
             assert_raises_rpc_error(-8, 'Invalid selected statistic %s' % inv_sel_stat,
-                                    self.nodes[0].getblockstats, hash_or_height=1, stats=inv_stat)
+                                    getblockstats, hash_or_height=1, stats=inv_stat)
 
         # Make sure we aren't always returning inv_sel_stat as the culprit stat
         assert_raises_rpc_error(-8, 'Invalid selected statistic aaa%s' % inv_sel_stat,
-                                self.nodes[0].getblockstats, hash_or_height=1, stats=['minfee' , 'aaa%s' % inv_sel_stat])
+                                getblockstats, hash_or_height=1, stats=['minfee' , 'aaa%s' % inv_sel_stat])
         # Mainchain's genesis block shouldn't be found on regtest
-        assert_raises_rpc_error(-5, 'Block not found', self.nodes[0].getblockstats,
+        assert_raises_rpc_error(-5, 'Block not found', getblockstats,
                                 hash_or_height='000000000019d6689c085ae165831e934ff763ae46a2a6c172b3f1b60a8ce26f')
 
         # Invalid number of args
-        assert_raises_rpc_error(-1, 'getblockstats hash_or_height ( stats )', self.nodes[0].getblockstats, '00', 1, 2)
-        assert_raises_rpc_error(-1, 'getblockstats hash_or_height ( stats )', self.nodes[0].getblockstats)
+        assert_raises_rpc_error(-1, 'getblockstats hash_or_height ( stats )', getblockstats, '00', 1, 2)
+        assert_raises_rpc_error(-1, 'getblockstats hash_or_height ( stats )', getblockstats)
 
 
 if __name__ == '__main__':